@@ -13,133 +13,577 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-# Runs a sequence of agents to analyze and respond to a comment within a given context and tone.
+# Runs an agent that analyzes and responds to a comment within a given context and tone.
 
-import json
-import uuid # Import uuid for unique session IDs
-from google.adk.agents import LlmAgent, SequentialAgent
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import secrets # For short unique session IDs
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Optional
+from google.adk.agents import LlmAgent
+from google.adk.agents.run_config import RunConfig, StreamingMode
+from google.adk.models import Gemini
 from google.genai import types
 from google.adk.sessions import InMemorySessionService
 from google.adk.runners import Runner
+import orjson
 from dotenv import load_dotenv
+from pydantic import BaseModel
 
+from .semantic_cache import SemanticCache
 from .util import load_instruction_from_file
 
+logger = logging.getLogger(__name__)
+
+load_dotenv() # Load .env once
+
+# --- Instructions ---
+# Read once at import and passed to the agents as plain strings
+COMMENT_INTERACTION_INSTR = load_instruction_from_file("comment_interaction_instruction.txt")
+BATCH_COMMENT_INSTR = load_instruction_from_file("batch_comment_instruction.txt")
+
 # --- Agent Definitions ---
-# (Keep agent definitions: state_setup_agent, comment_analyzer_agent, comment_responder_agent)
-state_setup_agent = LlmAgent(
-    name="StateSetup",
-    model="gemini-1.5-pro-latest", # Use Pro for reliable JSON parsing/output
-    instruction=load_instruction_from_file("state_setup_instruction.txt"),
-    output_key="initial_data" # Output the dict containing comment, context, tone
-)
-comment_analyzer_agent = LlmAgent(
-    name="CommentAnalyzer",
-    model="gemini-1.5-flash",
-    instruction=load_instruction_from_file("comment_analyzer_instruction.txt"),
-    output_key="analysis",
-)
-comment_responder_agent = LlmAgent(
-    name="CommentResponder",
-    model="gemini-1.5-flash",
-    instruction=load_instruction_from_file("comment_responder_instruction.txt"),
-    output_key="final_response",
-)
+# Agents given a model name build a new Gemini client (and HTTP connection pool) for
+# every call; sharing one instance keeps connections alive across calls and agents
+gemini_flash = Gemini(model="gemini-1.5-flash")
 
-# --- Sequence Agent Workflow ---
-comment_interaction_agent = SequentialAgent(
+class CommentInteractionResult(BaseModel):
+    # Field order is sent to Gemini as the property order; the reply comes first so
+    # streamed output starts with user-visible text
+    final_response: str # Reply to post under the comment
+    analysis: str # Short analysis of the incoming comment
+
+
+# Analysis and reply are produced by one Flash call instead of a 3-agent sequence;
+# the caller already sends comment/context/tone as JSON, so no state setup step is needed
+comment_interaction_agent = LlmAgent(
     name="CommentInteraction",
-    sub_agents=[state_setup_agent, comment_analyzer_agent, comment_responder_agent]
+    model=gemini_flash,
+    instruction=COMMENT_INTERACTION_INSTR,
+    output_schema=CommentInteractionResult,
+    output_key="result", # Saved to state as {"analysis": ..., "final_response": ...}
+    disallow_transfer_to_parent=True, # Required alongside output_schema
+    disallow_transfer_to_peers=True,
+)
+
+
+class BatchedCommentResponse(BaseModel):
+    id: int # Index of the comment in the batch
+    final_response: str
+
+
+class BatchedCommentResults(BaseModel):
+    responses: list[BatchedCommentResponse]
+
+
+# Replies to several comments on the same post in one call (see micro-batching below)
+batch_comment_agent = LlmAgent(
+    name="BatchCommentInteraction",
+    model=gemini_flash,
+    instruction=BATCH_COMMENT_INSTR,
+    output_schema=BatchedCommentResults,
+    output_key="batch_result",
+    disallow_transfer_to_parent=True,
+    disallow_transfer_to_peers=True,
 )
 
+# --- Session Service ---
+class BoundedInMemorySessionService(InMemorySessionService):
+    """InMemorySessionService that evicts the least recently used sessions past maxsize.
+
+    Sessions are normally deleted once a run completes; the cap keeps memory bounded
+    if cleanup is ever skipped (e.g. a crashed or cancelled request).
+    """
+
+    def __init__(self, maxsize: int = 10_000):
+        super().__init__()
+        self.maxsize = maxsize
+        self._lru: "OrderedDict[tuple, None]" = OrderedDict() # (app_name, user_id, session_id)
+
+    def create_session(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        state: Optional[dict[str, Any]] = None,
+        session_id: Optional[str] = None,
+    ):
+        session = super().create_session(
+            app_name=app_name, user_id=user_id, state=state, session_id=session_id
+        )
+        self._lru[(app_name, user_id, session.id)] = None
+        while len(self._lru) > self.maxsize:
+            old_app, old_user, old_id = self._lru.popitem(last=False)[0]
+            super().delete_session(app_name=old_app, user_id=old_user, session_id=old_id)
+        return session
+
+    def get_session(self, *, app_name: str, user_id: str, session_id: str, **kwargs):
+        key = (app_name, user_id, session_id)
+        if key in self._lru:
+            self._lru.move_to_end(key)
+        return super().get_session(
+            app_name=app_name, user_id=user_id, session_id=session_id, **kwargs
+        )
+
+    def delete_session(self, *, app_name: str, user_id: str, session_id: str) -> None:
+        self._lru.pop((app_name, user_id, session_id), None)
+        super().delete_session(app_name=app_name, user_id=user_id, session_id=session_id)
+
+
 # --- Global/Shared Resources ---
-load_dotenv() # Load .env once
 APP_NAME = "comment_responder_app"
 USER_ID = "web_user_01" # Generic user ID for web interface
-session_service = InMemorySessionService() # Instantiate session service globally
+session_service = BoundedInMemorySessionService() # Instantiate session service globally
+# Runner holds no per-request state (that lives in session_service), so build it once
+runner = Runner(
+    agent=comment_interaction_agent,
+    app_name=APP_NAME,
+    session_service=session_service
+)
+batch_runner = Runner(
+    agent=batch_comment_agent,
+    app_name=APP_NAME,
+    session_service=session_service
+)
+
+# --- Response Cache ---
+# Bounded LRU of successful results keyed by a hash of (comment, context, tone)
+RESPONSE_CACHE_MAXSIZE = 1024
+_response_cache: "OrderedDict[str, dict]" = OrderedDict()
+_inflight: "dict[str, asyncio.Future]" = {} # Single-flight: key -> result of the run in progress
+_cache_stats = {"hits": 0, "misses": 0, "coalesced": 0, "semantic_hits": 0}
+
+
+class _LeaderCancelled(Exception):
+    """Set on an in-flight future when the request running it is cancelled."""
+
+
+# Optional near-duplicate lookup on exact-cache misses (SEMANTIC_CACHE=1 to enable)
+semantic_cache = None
+if os.getenv("SEMANTIC_CACHE", "").lower() in ("1", "true"):
+    try:
+        semantic_cache = SemanticCache()
+    except ImportError as e:
+        logger.warning("Semantic cache disabled: %s", e)
+
+
+def _cache_key(comment: str, context: str, tone: str) -> str:
+    payload = orjson.dumps({"c": comment, "x": context, "t": tone}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+
+def get_cache_stats() -> dict:
+    """Returns hit/miss/coalesced counters and current size of the response cache."""
+    return {
+        **_cache_stats,
+        "size": len(_response_cache),
+        "maxsize": RESPONSE_CACHE_MAXSIZE,
+    }
+
+
+async def run_comment_interaction(comment: str, context: str, tone: str) -> dict:
+    """Runs the agent pipeline, serving repeated (comment, context, tone) inputs from cache."""
+    key = _cache_key(comment, context, tone)
+    cached = _cache_lookup(key)
+    if cached is not None:
+        return cached
+
+    # Identical requests arriving while a run is in flight await its result
+    # instead of starting another pipeline
+    inflight = _inflight.get(key)
+    if inflight is not None:
+        _cache_stats["coalesced"] += 1
+        try:
+            return await asyncio.shield(inflight)
+        except _LeaderCancelled:
+            # The leader was cancelled (e.g. its client disconnected) and its key is
+            # already gone, so retry and lead or join a fresh run
+            return await run_comment_interaction(comment, context, tone)
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        result = await _answer_comment(comment, context, tone)
+        _cache_store(key, result)
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        # Don't cancel the shared future: that would cancel the followers too
+        future.set_exception(_LeaderCancelled())
+        future.exception()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception() # Mark as retrieved; waiters still receive the exception
+        raise
+    finally:
+        _inflight.pop(key, None)
+
+
+async def stream_comment_interaction(comment: str, context: str, tone: str) -> AsyncGenerator[tuple, None]:
+    """Streams the agent's reply as it is generated.
+
+    Yields ("token", text) with each new piece of the reply text (only the
+    final_response value, decoded from the streamed JSON), then a single
+    ("done", result) with the same result dict run_comment_interaction returns.
+    Streamed requests bypass micro-batching, since a batch has no per-comment stream.
+    """
+    key = _cache_key(comment, context, tone)
+    cached = _cache_lookup(key)
+    if cached is not None:
+        yield "done", cached
+        return
+
+    session_id = _new_session_id()
+    logger.debug("Starting streamed interaction for session: %s", session_id)
+    streaming_config = RunConfig(streaming_mode=StreamingMode.SSE)
+    reply = _JsonStringFieldStream("final_response")
+    async for kind, value in _stream_agent(runner, session_id, _comment_message(comment, context, tone), streaming_config):
+        if kind == "token":
+            if reply is None:
+                continue
+            try:
+                text = reply.feed(value)
+            except ValueError:
+                # Undecodable output (e.g. a raw control character); stop streaming
+                # tokens but keep draining so the final result is still built and stored
+                logger.warning("Stopped streaming undecodable reply for session: %s", session_id)
+                reply = None
+                continue
+            if text:
+                yield "token", text
+        else:
+            result = _build_result(session_id, *value)
+
+    _cache_store(key, result)
+    logger.debug("Streamed interaction complete for session: %s", session_id)
+    yield "done", result
+
+
+class _JsonStringFieldStream:
+    """Incrementally decodes one string field from a JSON object streamed in chunks.
+
+    feed() returns the newly available part of the field's value; escape
+    sequences split across chunks are held back until they are complete.
+    """
+
+    _HEX = set("0123456789abcdefABCDEF")
+
+    def __init__(self, field: str):
+        self._key = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+        self._buffer = ""
+        self._start = None # Offset of the value's first character in _buffer
+        self._emitted = 0 # Number of decoded characters already returned
+        self._done = False
+
+    def feed(self, chunk: str) -> str:
+        if self._done:
+            return ""
+        self._buffer += chunk
+        if self._start is None:
+            match = self._key.search(self._buffer)
+            if match is None:
+                return ""
+            self._start = match.end()
+
+        raw, self._done = self._complete_prefix(self._buffer[self._start:])
+        decoded = orjson.loads(f'"{raw}"')
+        text = decoded[self._emitted:]
+        self._emitted = len(decoded)
+        return text
+
+    def _complete_prefix(self, raw: str) -> tuple:
+        """Returns (longest prefix without a partial escape, whether the string ended)."""
+        i = 0
+        while i < len(raw):
+            char = raw[i]
+            if char == '"':
+                return raw[:i], True
+            if char == "\\":
+                if i + 1 >= len(raw):
+                    break
+                if raw[i + 1] != "u":
+                    i += 2
+                    continue
+                escape_end = i + 6
+                if escape_end > len(raw) or not set(raw[i + 2:escape_end]) <= self._HEX:
+                    break
+                # A high surrogate only decodes together with the low surrogate after it
+                if 0xD800 <= int(raw[i + 2:escape_end], 16) <= 0xDBFF:
+                    escape_end += 6
+                    if escape_end > len(raw):
+                        break
+                i = escape_end
+                continue
+            i += 1
+        return raw[:i], False
+
+
+async def _answer_comment(comment: str, context: str, tone: str) -> dict:
+    """Reuses the result of a near-duplicate comment if the semantic cache has one,
+    otherwise queues the comment for the agent."""
+    if semantic_cache is None:
+        return await _submit_to_batch(comment, context, tone)
+
+    partition = (context, tone) # Only reuse replies written for the same post and tone
+    embedding = await semantic_cache.embed(comment)
+    similar = semantic_cache.lookup(partition, embedding)
+    if similar is not None:
+        _cache_stats["semantic_hits"] += 1
+        return similar
+
+    result = await _submit_to_batch(comment, context, tone)
+    if not result.get("error") and result.get("final_response"):
+        semantic_cache.add(partition, embedding, result)
+    return result
+
+
+def _cache_lookup(key: str) -> Optional[dict]:
+    cached = _response_cache.get(key)
+    if cached is None:
+        _cache_stats["misses"] += 1
+        return None
+    _response_cache.move_to_end(key)
+    _cache_stats["hits"] += 1
+    return cached
+
+
+def _cache_store(key: str, result: dict) -> None:
+    # Only cache successful results so transient failures are retried
+    if not result.get("error") and result.get("final_response"):
+        _response_cache[key] = result
+        if len(_response_cache) > RESPONSE_CACHE_MAXSIZE:
+            _response_cache.popitem(last=False)
 
 
 # --- Interaction Function (Refactored) ---
-def run_comment_interaction(comment: str, context: str, tone: str) -> dict:
-    session_id = f"session_{uuid.uuid4()}" # Generate unique session ID
-    print(f"Starting interaction for session: {session_id}")
+def _new_session_id() -> str:
+    # 64 random bits is plenty for a key that only lives in memory for one run
+    return f"s_{secrets.token_hex(8)}"
+
 
-    # Prepare initial message
-    initial_message_data = {"comment": comment, "context": context, "tone": tone}
-    initial_message_content = json.dumps(initial_message_data)
+async def _run_agent(agent_runner: Runner, session_id: str, message_data: dict) -> tuple:
+    """Runs one agent invocation in a fresh session.
+
+    Returns a (final_state, final_response_text, error_message) tuple.
+    """
+    async for kind, value in _stream_agent(agent_runner, session_id, message_data):
+        if kind == "result":
+            return value
+
+
+async def _stream_agent(
+    agent_runner: Runner,
+    session_id: str,
+    message_data: dict,
+    run_config: RunConfig = RunConfig(),
+) -> AsyncGenerator[tuple, None]:
+    """Runs one agent invocation in a fresh session, yielding ("token", text) for
+    partial output and finally ("result", (final_state, final_response_text, error_message)).
+    """
+    initial_message_content = orjson.dumps(message_data).decode() # ADK expects str
     initial_message = types.Content(role="user", parts=[types.Part(text=initial_message_content)])
 
-    # Explicitly create the session
+    # Explicitly create the session, seeding its state with the inputs directly
+    # (this used to take a separate StateSetup LLM call)
     try:
         session = session_service.create_session(
-            app_name=APP_NAME, user_id=USER_ID, session_id=session_id
+            app_name=APP_NAME, user_id=USER_ID, session_id=session_id, state=message_data
         )
     except Exception as e:
-        print(f"Error creating session {session_id}: {e}")
-        return {"error": f"Failed to create session: {e}"}
-
-    # Create a Runner
-    runner = Runner(
-        agent=comment_interaction_agent,
-        app_name=APP_NAME,
-        session_service=session_service
-    )
+        logger.error("Error creating session %s: %s", session_id, e)
+        yield "result", ({}, None, f"Failed to create session: {e}")
+        return
 
     final_response_text = None
     error_message = None
     final_state_dict = {}
 
     try:
-        print(f"--- Running sequence for session: {session_id} ---")
-        events = runner.run(
+        logger.debug("Running agent for session: %s", session_id)
+        # Process events as they arrive without blocking the event loop
+        async for event in agent_runner.run_async(
             user_id=USER_ID,
             session_id=session_id,
-            new_message=initial_message
-        )
-
-        # Process events
-        for event in events:
-            if event.is_final_response():
+            new_message=initial_message,
+            run_config=run_config
+        ):
+            if event.partial:
+                if event.content and event.content.parts and event.content.parts[0].text:
+                    yield "token", event.content.parts[0].text
+            elif event.is_final_response():
                 final_response_text = event.content.parts[0].text
 
         # Fetch final state
         final_session = session_service.get_session(app_name=APP_NAME, user_id=USER_ID, session_id=session_id)
         if final_session:
             final_state_dict = final_session.state
-            print(f"Final State for {session_id}: {final_state_dict}") # Log final state
+            logger.debug("Final State for %s: %s", session_id, final_state_dict) # Formatted only if DEBUG is on
         else:
-             print(f"Warning: Could not retrieve final state for session {session_id}")
+             logger.warning("Could not retrieve final state for session %s", session_id)
              error_message = "Failed to retrieve final session state."
 
     except Exception as e:
-        print(f"Error during agent execution for session {session_id}: {e}")
+        logger.error("Error during agent execution for session %s: %s", session_id, e)
         # Attempt to fetch state even after error, might have partial results
         try:
             final_session = session_service.get_session(app_name=APP_NAME, user_id=USER_ID, session_id=session_id)
             if final_session:
                 final_state_dict = final_session.state
         except Exception as final_state_e:
-             print(f"Could not retrieve state after error for {session_id}: {final_state_e}")
+             logger.error("Could not retrieve state after error for %s: %s", session_id, final_state_e)
         error_message = f"Agent execution failed: {e}"
+    finally:
+        # Nothing reads the session after this returns, so drop it to keep memory flat
+        session_service.delete_session(app_name=APP_NAME, user_id=USER_ID, session_id=session_id)
+
+    yield "result", (final_state_dict, final_response_text, error_message)
 
-    # --- Prepare results --- 
+
+def _comment_message(comment: str, context: str, tone: str) -> dict:
+    # Keys are ordered static-to-dynamic so the instruction and post context form a
+    # byte-identical prefix for every comment on a post. This only prepares for models
+    # with implicit prefix caching; gemini-1.5-flash has none, and the prefix is below
+    # the minimum cacheable size anyway
+    return {"context": context, "tone": tone, "comment": comment}
+
+
+def _build_result(session_id: str, final_state_dict: dict, final_response_text: Optional[str], error_message: Optional[str]) -> dict:
     result = {
         "session_id": session_id,
         "final_state": final_state_dict,
-        "final_response": final_state_dict.get("final_response"), # Get from state if possible
+        "final_response": (final_state_dict.get("result") or {}).get("final_response"), # Get from state if possible
         "error": error_message
     }
 
-    # Fallback to response text from event if not in state
+    # Fallback to the structured response text from the event if not in state
     if not result["final_response"] and final_response_text:
-        result["final_response"] = final_response_text
+        try:
+            result["final_response"] = orjson.loads(final_response_text).get("final_response")
+        except (ValueError, AttributeError):
+            logger.warning("Could not parse final response for session %s", session_id)
+    return result
+
 
-    # Clean up session from memory if needed (optional, depends on expected load)
-    # session_service.delete_session(app_name=APP_NAME, user_id=USER_ID, session_id=session_id)
+async def _run_pipeline(comment: str, context: str, tone: str) -> dict:
+    session_id = _new_session_id()
+    logger.debug("Starting interaction for session: %s", session_id)
 
-    print(f"Interaction complete for session: {session_id}")
+    final_state_dict, final_response_text, error_message = await _run_agent(
+        runner, session_id, _comment_message(comment, context, tone)
+    )
+    result = _build_result(session_id, final_state_dict, final_response_text, error_message)
+
+    logger.debug("Interaction complete for session: %s", session_id)
     return result
 
+
+async def _run_batch_pipeline(context: str, items: list) -> list:
+    """Answers several (comment, tone) pairs on the same post with one agent call."""
+    session_id = _new_session_id()
+    logger.debug("Starting batch of %d comments for session: %s", len(items), session_id)
+
+    # Same static-to-dynamic ordering as the single-comment prompt
+    batch_message_data = {
+        "context": context,
+        "comments": [
+            {"id": i, "tone": tone, "comment": comment}
+            for i, (comment, tone) in enumerate(items)
+        ],
+    }
+    final_state_dict, final_response_text, error_message = await _run_agent(
+        batch_runner, session_id, batch_message_data
+    )
+
+    batch_result = final_state_dict.get("batch_result")
+    if not batch_result and final_response_text:
+        try:
+            batch_result = orjson.loads(final_response_text)
+        except ValueError:
+            logger.warning("Could not parse batch response for session %s", session_id)
+    responses = {
+        r.get("id"): r.get("final_response")
+        for r in (batch_result or {}).get("responses", [])
+    }
+
+    results = []
+    for i in range(len(items)):
+        final_response = responses.get(i)
+        results.append({
+            "session_id": session_id,
+            "final_state": final_state_dict,
+            "final_response": final_response,
+            "error": error_message or (None if final_response else "Batch response missing comment."),
+        })
+
+    logger.debug("Batch complete for session: %s", session_id)
+    return results
+
+
+# --- Micro-batching ---
+# Comments on the same post that arrive within BATCH_WINDOW_SECONDS of each other
+# are answered by a single agent call, sharing the post context across the batch
+BATCH_MAX_SIZE = 16
+BATCH_WINDOW_SECONDS = 0.05
+_batch_queues: dict = {} # context -> asyncio.Queue of (future, comment, tone)
+_batch_workers: set = set() # Strong references so running workers aren't garbage collected
+_batch_runs: set = set() # Same for batches whose agent call is in flight
+
+
+def _submit_to_batch(comment: str, context: str, tone: str) -> asyncio.Future:
+    future = asyncio.get_running_loop().create_future()
+    queue = _batch_queues.get(context)
+    if queue is None:
+        queue = _batch_queues[context] = asyncio.Queue()
+        worker = asyncio.create_task(_batch_worker(context, queue))
+        _batch_workers.add(worker)
+        worker.add_done_callback(_batch_workers.discard)
+    queue.put_nowait((future, comment, tone))
+    return future
+
+
+async def _batch_worker(context: str, queue: asyncio.Queue) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_SECONDS
+        try:
+            while len(batch) < BATCH_MAX_SIZE:
+                batch.append(await asyncio.wait_for(queue.get(), timeout=max(deadline - loop.time(), 0)))
+        except asyncio.TimeoutError:
+            pass
+
+        # Run the batch in its own task so the next window starts collecting right
+        # away instead of waiting for this LLM call to finish
+        run = asyncio.create_task(_run_batch(context, batch))
+        _batch_runs.add(run)
+        run.add_done_callback(_batch_runs.discard)
+
+        # Retire idle workers; submitters create a new queue on the next comment
+        if queue.empty():
+            del _batch_queues[context]
+            return
+
+
+async def _run_batch(context: str, batch: list) -> None:
+    items = [(comment, tone) for _, comment, tone in batch]
+    try:
+        if len(items) == 1:
+            results = [await _run_pipeline(items[0][0], context, items[0][1])]
+        else:
+            results = await _run_batch_pipeline(context, items)
+    except Exception as e:
+        logger.exception("Error running comment batch: %s", e)
+        results = [{"error": f"Agent execution failed: {e}"} for _ in items]
+
+    for (future, _, _), result in zip(batch, results):
+        if not future.done():
+            future.set_result(result)
+
+
 # --- Remove Example Usage Block --- 
 # (The old example usage calling run_comment_interaction directly is removed)
 
@@ -1,22 +1,67 @@
 #!/usr/bin/env python
 import uvicorn
-from fastapi import FastAPI, HTTPException # Import HTTPException for errors
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request # Import HTTPException for errors
+from pydantic import BaseModel, ConfigDict
 from typing import Dict, Any, Literal, List, Optional # Add List, Optional
 from fastapi.middleware.cors import CORSMiddleware # For allowing frontend requests
-from fastapi.responses import FileResponse # Import FileResponse
+from fastapi.responses import Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles # Import StaticFiles
+import asyncio
+import hashlib
+import itertools
+import logging
+import logging.handlers
 import os
+import queue
+import re
+from collections import deque
+from contextlib import asynccontextmanager
+
+import orjson
+
+# --- Logging ---
+# Handlers only enqueue records; a background thread does the actual writes,
+# so request handlers never block on stdout
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+def _configure_logging() -> logging.handlers.QueueListener:
+    # `python main.py` imports this file twice (as __main__ and as main); both copies
+    # must share one queue handler and listener so shutdown flushes the right one
+    root = logging.getLogger()
+    for handler in root.handlers:
+        if isinstance(handler, logging.handlers.QueueHandler) and getattr(handler, "listener", None) is not None:
+            return handler.listener
+    log_queue: queue.Queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    # Root stays at WARNING: google.adk logs full prompts and responses at INFO, and
+    # httpx logs every request; only the app's own loggers follow LOG_LEVEL
+    root.setLevel(logging.WARNING)
+    root.addHandler(queue_handler)
+    queue_handler.listener.start()
+    return queue_handler.listener
+
+_log_listener = _configure_logging()
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
 
 # Import the core interaction logic from our refactored runner script
 # Ensure loop_agent_runner.py is in the same directory or accessible via PYTHONPATH
 try:
-    from loop_agent_runner import run_comment_interaction
+    from loop_agent_runner import run_comment_interaction, stream_comment_interaction, get_cache_stats
 except ImportError as e:
-    print(f"Error importing from loop_agent_runner: {e}")
-    print("Make sure loop_agent_runner.py is in the correct path.")
+    logger.error("Error importing from loop_agent_runner: %s", e)
+    logger.error("Make sure loop_agent_runner.py is in the correct path.")
+    _log_listener.stop()
     exit(1)
 
+# The runner's package (or the runner itself, if imported top-level) covers the
+# runner, util and semantic_cache loggers
+_runner_module = run_comment_interaction.__module__
+logging.getLogger(_runner_module.rpartition(".")[0] or _runner_module).setLevel(LOG_LEVEL)
+
 # --- Mock Blog Post Data ---
 # Using slugs as keys for easy URL mapping
 mock_posts = {
@@ -47,17 +92,25 @@ mock_posts = {
         "comments": []
     }
 }
-next_comment_id = 4 # Simple counter for new comment IDs
+FIRST_COMMENT_ID = 4 # Seed comments use c1-c3
 
 # --- API Data Models ---
 
+# Stored/returned models are immutable once built, so they can be shared between
+# the store, the response caches and the API without defensive copies
+READ_ONLY_MODEL_CONFIG = ConfigDict(frozen=True, extra="ignore")
+
 # Model for the agent response part within a comment
 class AgentResponse(BaseModel):
+    model_config = READ_ONLY_MODEL_CONFIG
+
     tone: str
     text: str
 
 # Model for a single comment
 class Comment(BaseModel):
+    model_config = READ_ONLY_MODEL_CONFIG
+
     id: str
     commenter: str # Keep simple for now, could be more complex
     text: str
@@ -65,11 +118,15 @@ class Comment(BaseModel):
 
 # Model for returning a list of posts (summary)
 class PostSummary(BaseModel):
+    model_config = READ_ONLY_MODEL_CONFIG
+
     title: str
     slug: str
 
 # Model for returning detailed post info including comments
 class PostDetail(BaseModel):
+    model_config = READ_ONLY_MODEL_CONFIG
+
     title: str
     slug: str
     content: str
@@ -82,96 +139,306 @@ class NewCommentRequest(BaseModel):
     text: str
     tone: Literal["neutral", "strict", "aggressive", "optimistic", "happy", "humorous"]
 
+# --- Post Store ---
+# Posts and comments live in process memory by default. Set REDIS_URL to keep them
+# in Redis instead, so several workers/instances serve the same data.
+
+class InMemoryPostStore:
+    def __init__(self, posts: Dict[str, Dict[str, Any]]):
+        self.posts = posts
+        # Validate the seed comments once so every post stores typed Comment objects
+        for post in posts.values():
+            post["comments"] = deque(Comment.model_validate(c) for c in post["comments"])
+        self._comment_ids = itertools.count(FIRST_COMMENT_ID) # Counter for new comment IDs
+        self._locks = {slug: asyncio.Lock() for slug in posts} # Serializes writes per post
+        # Serialized JSON of the read endpoints, rebuilt only after a write
+        self._list_cache: Optional[bytes] = None
+        self._detail_cache: Dict[str, bytes] = {}
+
+    async def setup(self) -> None:
+        pass # Nothing to seed; the posts are already in memory
+
+    async def get_post(self, slug: str) -> Optional[Dict[str, Any]]:
+        return self.posts.get(slug)
+
+    async def list_posts_json(self) -> bytes:
+        if self._list_cache is None:
+            summaries = [PostSummary(title=data["title"], slug=data["slug"]) for data in self.posts.values()]
+            self._list_cache = orjson.dumps([summary.model_dump() for summary in summaries])
+        return self._list_cache
+
+    async def get_post_json(self, slug: str) -> Optional[bytes]:
+        cached = self._detail_cache.get(slug)
+        if cached is None:
+            post = self.posts.get(slug)
+            if not post:
+                return None
+            # Comments are already validated Comment objects, so skip re-validation
+            detail = PostDetail.model_construct(**{**post, "comments": list(post["comments"])})
+            cached = self._detail_cache[slug] = detail.model_dump_json().encode()
+        return cached
+
+    async def add_comment(self, slug: str, commenter: str, text: str, agent_response: Optional[AgentResponse]) -> Comment:
+        async with self._locks[slug]:
+            comment = Comment(
+                id=f"c{next(self._comment_ids)}",
+                commenter=commenter,
+                text=text,
+                agent_response=agent_response
+            )
+            self.posts[slug]["comments"].append(comment) # Store the validated model
+            self._detail_cache.pop(slug, None) # Invalidate the serialized detail view
+        return comment
+
+
+class RedisPostStore:
+    # Keys: "posts" (list of slugs), "post:<slug>" (hash of post fields),
+    # "post:<slug>:comments" (list of comment JSON), "comment:id_counter" (INCR counter)
+    POST_FIELDS = ("title", "slug", "content", "audio_url")
+
+    def __init__(self, url: str, seed_posts: Dict[str, Dict[str, Any]]):
+        import redis.asyncio as redis # Optional dependency, only needed with REDIS_URL
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.seed_posts = seed_posts
+
+    async def setup(self) -> None:
+        # Seed the mock data only if no process has yet. WATCH makes the EXISTS check and
+        # the writes one atomic step: if another worker seeds in between, EXEC aborts and
+        # its data is already fully visible; a crash mid-seed leaves nothing behind
+        from redis.exceptions import WatchError
+        async with self.redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch("posts")
+                if await pipe.exists("posts"):
+                    return
+                pipe.multi()
+                for slug, post in self.seed_posts.items():
+                    pipe.rpush("posts", slug)
+                    pipe.hset(f"post:{slug}", mapping={k: post[k] for k in self.POST_FIELDS if post.get(k) is not None})
+                    if post["comments"]:
+                        pipe.rpush(f"post:{slug}:comments", *(Comment.model_validate(c).model_dump_json() for c in post["comments"]))
+                pipe.set("comment:id_counter", FIRST_COMMENT_ID - 1) # INCR hands out FIRST_COMMENT_ID next
+                await pipe.execute()
+            except WatchError:
+                pass # Another worker seeded first
+
+    async def get_post(self, slug: str) -> Optional[Dict[str, Any]]:
+        return await self.redis.hgetall(f"post:{slug}") or None
+
+    async def list_posts_json(self) -> bytes:
+        slugs = await self.redis.lrange("posts", 0, -1)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for slug in slugs:
+                pipe.hget(f"post:{slug}", "title")
+            titles = await pipe.execute()
+        return orjson.dumps([{"title": title, "slug": slug} for slug, title in zip(slugs, titles)])
+
+    async def get_post_json(self, slug: str) -> Optional[bytes]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(f"post:{slug}")
+            pipe.lrange(f"post:{slug}:comments", 0, -1)
+            post, comments = await pipe.execute()
+        if not post:
+            return None
+        return orjson.dumps({
+            "title": post["title"],
+            "slug": post["slug"],
+            "content": post["content"],
+            "comments": [orjson.loads(c) for c in comments],
+            "audio_url": post.get("audio_url"),
+        })
+
+    async def add_comment(self, slug: str, commenter: str, text: str, agent_response: Optional[AgentResponse]) -> Comment:
+        # INCR is atomic across workers, so ids never collide
+        comment = Comment(
+            id=f"c{await self.redis.incr('comment:id_counter')}",
+            commenter=commenter,
+            text=text,
+            agent_response=agent_response
+        )
+        await self.redis.rpush(f"post:{slug}:comments", comment.model_dump_json())
+        return comment
+
+
+REDIS_URL = os.getenv("REDIS_URL")
+store = RedisPostStore(REDIS_URL, mock_posts) if REDIS_URL else InMemoryPostStore(mock_posts)
+
+# --- Static Assets ---
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+INDEX_PATH = os.path.join(BASE_DIR, "index.html")
+STATIC_CACHE_CONTROL = "public, max-age=3600"
+INDEX_CACHE_CONTROL = "public, max-age=300"
+
+# StaticFiles already handles ETag/Last-Modified and 304s; add a Cache-Control header too
+class CachedStaticFiles(StaticFiles):
+    def file_response(self, *args, **kwargs) -> Response:
+        response = super().file_response(*args, **kwargs)
+        response.headers.setdefault("Cache-Control", STATIC_CACHE_CONTROL)
+        return response
+
+# Read the frontend page once at startup and serve it from memory
+try:
+    with open(INDEX_PATH, "rb") as f:
+        _index_bytes: Optional[bytes] = f.read()
+    _index_etag: Optional[str] = f'"{hashlib.sha256(_index_bytes).hexdigest()[:32]}"'
+except FileNotFoundError:
+    logger.warning("index.html not found; '/' will return 404.")
+    _index_bytes = _index_etag = None
+
 # --- FastAPI App Setup ---
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await store.setup()
+    yield
+    _log_listener.stop() # Flush queued log records on shutdown
+
 app = FastAPI(
     title="Mock Blog Comment Agent API",
-    description="API for a mock blog site where agents respond to comments."
+    description="API for a mock blog site where agents respond to comments.",
+    lifespan=lifespan
 )
 
-# Mount static files directory
-app.mount("/static", StaticFiles(directory="."), name="static")
+# Mount static files directory (audio files live in ./static, not the repo root)
+app.mount("/static", CachedStaticFiles(directory=STATIC_DIR), name="static")
 
-# Add CORS middleware to allow requests from any origin (adjust for production)
+# Add CORS middleware for the frontend origins (comma-separated ALLOWED_ORIGINS)
+ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "http://localhost:8002,http://127.0.0.1:8002").split(",")
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"], # Allows all origins
-    allow_credentials=True,
-    allow_methods=["*"], # Allows all methods
-    allow_headers=["*"], # Allows all headers
+    allow_origins=[origin.strip() for origin in ALLOWED_ORIGINS if origin.strip()],
+    allow_credentials=False, # The API uses no cookies or auth headers
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type"],
 )
 
 # --- API Endpoints ---
 
 @app.get("/", include_in_schema=False) # Add endpoint for root path
-async def read_index():
+async def read_index(request: Request):
     """Serves the index.html file for the frontend."""
-    return FileResponse('index.html')
+    if _index_bytes is None:
+        raise HTTPException(status_code=404, detail="index.html not found")
+    headers = {"Cache-Control": INDEX_CACHE_CONTROL, "ETag": _index_etag}
+    if request.headers.get("if-none-match") == _index_etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=_index_bytes, media_type="text/html", headers=headers)
 
 # List all available blog posts (summaries)
 @app.get("/api/posts", response_model=List[PostSummary])
 async def list_posts():
-    return [PostSummary(title=data["title"], slug=data["slug"]) for data in mock_posts.values()]
+    return Response(content=await store.list_posts_json(), media_type="application/json")
 
 # Get details for a specific blog post
 @app.get("/api/posts/{post_slug}", response_model=PostDetail)
 async def get_post(post_slug: str):
-    post = mock_posts.get(post_slug)
-    if not post:
+    post_json = await store.get_post_json(post_slug)
+    if post_json is None:
         raise HTTPException(status_code=404, detail="Post not found")
-    return PostDetail(**post)
+    return Response(content=post_json, media_type="application/json")
+
+# Report hit/miss counters for the agent response cache
+@app.get("/api/cache/stats")
+async def cache_stats():
+    return get_cache_stats()
 
 # Add a comment to a specific blog post and trigger agent response
 @app.post("/api/posts/{post_slug}/comments", response_model=Comment)
 async def add_comment(post_slug: str, request: NewCommentRequest):
-    global next_comment_id
-    post = mock_posts.get(post_slug)
+    post = await store.get_post(post_slug)
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
 
-    # Prepare context for the agent
-    post_context = f"Blog Post Title: {post['title']}\n\n{post['content']}"
-
     # Run the agent interaction logic
-    print(f"Running agent for new comment on '{post_slug}' with tone '{request.tone}'")
-    agent_result = run_comment_interaction(
+    logger.debug("Running agent for new comment on '%s' with tone '%s'", post_slug, request.tone)
+    agent_result = await run_comment_interaction(
         comment=request.text,
-        context=post_context,
+        context=_post_context(post),
         tone=request.tone
     )
 
+    return await _store_comment(post_slug, request, agent_result) # Return the newly added comment object
+
+# Same as add_comment, but streams the agent's output as Server-Sent Events.
+# Emits "token" events with decoded pieces of the reply text (final_response only),
+# then one "done" event carrying the stored comment as JSON. A cached reply sends
+# only the "done" event, with no tokens.
+@app.post("/api/posts/{post_slug}/comments/stream")
+async def add_comment_stream(post_slug: str, request: NewCommentRequest):
+    post = await store.get_post(post_slug)
+    if not post:
+        raise HTTPException(status_code=404, detail="Post not found")
+
+    logger.debug("Streaming agent for new comment on '%s' with tone '%s'", post_slug, request.tone)
+
+    async def event_stream():
+        async for kind, value in stream_comment_interaction(
+            comment=request.text,
+            context=_post_context(post),
+            tone=request.tone
+        ):
+            if kind == "token":
+                yield _sse_event("token", value)
+            else:
+                new_comment_data = await _store_comment(post_slug, request, value)
+                yield _sse_event("done", new_comment_data.model_dump_json())
+
+    # Disable caching and proxy buffering (e.g. nginx) so tokens reach the client as sent
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def _post_context(post: dict) -> str:
+    # Prepare context for the agent
+    return f"Blog Post Title: {post['title']}\n\n{post['content']}"
+
+_SSE_LINE_BREAK = re.compile(r"\r\n|\r|\n")
+
+def _sse_event(event: str, data: str) -> str:
+    # Multi-line payloads need one "data:" field per line; SSE ends a line at \r\n, \r or \n
+    data_lines = "".join(f"data: {line}\n" for line in _SSE_LINE_BREAK.split(data))
+    return f"event: {event}\n{data_lines}\n"
+
+async def _store_comment(post_slug: str, request: NewCommentRequest, agent_result: dict) -> Comment:
     generated_response_text = None
     if agent_result.get("error"):
-        print(f"Agent Error: {agent_result['error']}")
+        logger.warning("Agent Error: %s", agent_result["error"])
         # Decide how to handle agent errors - maybe store comment without response?
         # For now, we'll store it without an agent response.
         agent_response_obj = None
     elif agent_result.get("final_response"):
         generated_response_text = agent_result["final_response"]
         agent_response_obj = AgentResponse(tone=request.tone, text=generated_response_text)
-        print(f"Agent Response Generated: {generated_response_text[:100]}...")
+        logger.debug("Agent Response Generated: %.100s...", generated_response_text)
     else:
-        print("Agent did not produce a final response.")
+        logger.warning("Agent did not produce a final response.")
         agent_response_obj = None
 
 
     # Create and store the new comment (including agent response if generated)
-    new_comment_data = Comment(
-        id=f"c{next_comment_id}",
-        commenter=request.commenter,
-        text=request.text,
-        agent_response=agent_response_obj
-    )
-    mock_posts[post_slug]["comments"].append(new_comment_data.model_dump()) # Store as dict
-    next_comment_id += 1
-
-    return new_comment_data # Return the newly added comment object
+    return await store.add_comment(post_slug, request.commenter, request.text, agent_response_obj)
 
 # --- Server Execution (for direct running) ---
 
 if __name__ == "__main__":
-    print("Starting Uvicorn server for Mock Blog...")
+    logger.info("Starting Uvicorn server for Mock Blog...")
     # Run the server on host 0.0.0.0 to make it accessible on the network
     # Default port is 8000
-    # Use reload=True for development to automatically restart on code changes
-    uvicorn.run("main:app", host="0.0.0.0", port=8002, reload=True) 
\ No newline at end of file
+    # Without REDIS_URL, posts and comments live in process memory and each worker
+    # would hold its own copy; keep WEB_CONCURRENCY=1 unless the Redis store is used.
+    # Set RELOAD=1 in development to restart on code changes (single worker only).
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    reload = os.getenv("RELOAD", "").lower() in ("1", "true") and workers == 1
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8002,
+        workers=workers,
+        reload=reload,
+        loop="auto", # uvloop when installed (uvicorn[standard])
+        http="auto", # httptools when installed
+    ) 
\ No newline at end of file
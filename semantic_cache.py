@@ -0,0 +1,88 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Reuses agent results for near-duplicate comments ("great post!" vs "nice post!").
+# Needs the optional sentence-transformers and faiss-cpu packages.
+
+import asyncio
+from typing import TYPE_CHECKING, Any, Hashable, Optional
+
+if TYPE_CHECKING:
+    import numpy as np
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+SIMILARITY_THRESHOLD = 0.95 # Minimum cosine similarity to reuse a result
+MAX_ENTRIES_PER_PARTITION = 10_000
+
+
+class SemanticCache:
+    """Embedding index of answered comments, partitioned so results are only reused
+    for the same post context and tone."""
+
+    def __init__(
+        self,
+        model_name: str = MODEL_NAME,
+        threshold: float = SIMILARITY_THRESHOLD,
+        max_entries: int = MAX_ENTRIES_PER_PARTITION,
+    ):
+        # Imported here rather than at module level: torch alone takes seconds and
+        # hundreds of MB, which only processes that enable the cache should pay
+        try:
+            import faiss
+            import numpy as np
+            import torch
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError("SemanticCache requires sentence-transformers and faiss-cpu") from e
+        self._faiss = faiss
+        self._np = np
+
+        model = SentenceTransformer(model_name, device="cpu")
+        # Dynamic int8 quantization of the Linear layers: smaller and faster on CPU
+        self.model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.dim = model.get_sentence_embedding_dimension()
+        self.threshold = threshold
+        self.max_entries = max_entries
+        # partition -> (inner-product index over normalized embeddings, results by row)
+        self._partitions: dict = {}
+
+    async def embed(self, text: str) -> "np.ndarray":
+        """Returns the L2-normalized embedding of text, computed off the event loop."""
+        return await asyncio.to_thread(self._encode, text)
+
+    def lookup(self, partition: Hashable, embedding: "np.ndarray") -> Optional[Any]:
+        """Returns the result stored for the most similar comment, if similar enough."""
+        entry = self._partitions.get(partition)
+        if entry is None:
+            return None
+        index, results = entry
+        scores, rows = index.search(embedding, 1)
+        if rows[0][0] >= 0 and scores[0][0] >= self.threshold:
+            return results[rows[0][0]]
+        return None
+
+    def add(self, partition: Hashable, embedding: "np.ndarray", result: Any) -> None:
+        entry = self._partitions.get(partition)
+        if entry is None:
+            entry = self._partitions[partition] = (self._faiss.IndexFlatIP(self.dim), [])
+        index, results = entry
+        if len(results) >= self.max_entries:
+            return # Full; keep serving existing entries rather than growing unbounded
+        index.add(embedding)
+        results.append(result)
+
+    def _encode(self, text: str) -> "np.ndarray":
+        return self.model.encode(
+            [text], normalize_embeddings=True, convert_to_numpy=True
+        ).astype(self._np.float32)
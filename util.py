@@ -12,22 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import logging
 import os
 
+logger = logging.getLogger(__name__)
 
+
+@functools.cache
 def load_instruction_from_file(
     filename: str, default_instruction: str = "Default instruction."
 ) -> str:
-    """Reads instruction text from a file relative to this script."""
+    """Reads instruction text from a file relative to this script.
+
+    Results are cached, so each file is read from disk at most once per process.
+    """
     instruction = default_instruction
     try:
         # Construct path relative to the current script file (__file__)
         filepath = os.path.join(os.path.dirname(__file__), filename)
         with open(filepath, "r", encoding="utf-8") as f:
             instruction = f.read()
-        print(f"Successfully loaded instruction from {filename}")
+        logger.debug("Successfully loaded instruction from %s", filename)
     except FileNotFoundError:
-        print(f"WARNING: Instruction file not found: {filepath}. Using default.")
+        logger.warning("Instruction file not found: %s. Using default.", filepath)
     except Exception as e:
-        print(f"ERROR loading instruction file {filepath}: {e}. Using default.")
+        logger.error("Error loading instruction file %s: %s. Using default.", filepath, e)
     return instruction